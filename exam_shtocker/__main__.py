@@ -1,14 +1,16 @@
 import logging
 import argparse
-from colorama import Fore
 import sys
-import auth
-import update_checker
-import scraper
-import time
-from processor import ExamProcessor
+from typing import TYPE_CHECKING
 from VERSION import VERSION
 
+# Everything else is imported inside main() after the --version check, so that
+# --version and --help don't pay for importing requests, selenium, pypdf etc.
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    import requests
+    import scraper
+
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +56,52 @@ parser.add_argument(
     default=None,
     metavar="YYYY/YYYY",
 )
+parser.add_argument(
+    "--min-delay",
+    help="Minimum number of seconds to wait between requests to exampapers. Requests are already rate-limited and back off when the server asks them to, so this is only needed if the account still gets flagged. Default: 0.",
+    type=float,
+    default=0.0,
+    metavar="SECONDS",
+)
+
+
+def scrape_next_page(
+    next_page: "Future[tuple[bool, list[scraper.Exam]]]",
+    session: "requests.Session",
+    page: int,
+    academic_year: str | None,
+) -> None:
+    """Scrape a page of exams in the background without a loader. This is
+    intended to be run in a daemon thread while the previous page's exams are
+    still being processed, so that the scrape overlaps with processing but an
+    unfinished scrape never holds up exiting.
+
+    Parameters
+    ----------
+    next_page : Future[tuple[bool, list[scraper.Exam]]]
+        Future to set the result of scraper.scrape_exams_on_page (whether this
+        is the last page, and a list of exams on the page) or its error on.
+    session : requests.Session
+        Session to use for the request.
+    page : int
+        Page number to scrape. 0-indexed.
+    academic_year : str | None
+        Academic year to filter exams by.
+    """
+    import scraper
+
+    if not next_page.set_running_or_notify_cancel():
+        return
+
+    logger.info(f"Prefetching page {page} in the background...")
+    try:
+        next_page.set_result(
+            scraper.scrape_exams_on_page(
+                session, page, academic_year, show_loader=False
+            )
+        )
+    except BaseException as e:
+        next_page.set_exception(e)
 
 
 def main(args: argparse.Namespace) -> int:
@@ -75,9 +123,30 @@ def main(args: argparse.Namespace) -> int:
         logging.info(VERSION)
         return 0
 
+    import ssl
+    from concurrent.futures import Future
+    from threading import Thread
+    from colors import Fore
+    import auth
+    import hashing
+    import update_checker
+    import scraper
+    from processor import ExamProcessor
+    from rate_limiter import exampapers_limiter
+
+    # hashlib uses OpenSSL (_hashlib, with SHA-NI where the CPU supports it) when
+    # Python is built against OpenSSL, and a slower builtin fallback otherwise
+    hasher_module = type(hashing.new_hasher()).__module__
+    logger.debug(
+        f"Hashing with {hashing.HASH_ALGORITHM} from {hasher_module} ({ssl.OPENSSL_VERSION})."
+    )
+
+    # The update check runs in the background while the arguments are
+    # validated and the user logs in, and is reported once that is done
+    update_check = None
     if not args.skip_update_check:
         logger.info("Checking for updates...")
-        update_checker.check_for_updates()
+        update_check = update_checker.start_update_check()
     else:
         logger.info("Skipping update check.")
 
@@ -113,6 +182,12 @@ def main(args: argparse.Namespace) -> int:
             "Will error on unknown codes. Use --continue-on-unknown-code to change this behavior."
         )
 
+    if args.min_delay < 0:
+        logger.error("Invalid minimum delay.")
+        print(Fore.RED + "Minimum delay must not be negative." + Fore.RESET)
+        return 1
+    exampapers_limiter.min_interval = args.min_delay
+
     # Validate the academic year format if provided
     if args.academic_year:
         logger.info(f"Filtering exams by academic year: {args.academic_year}")
@@ -135,37 +210,80 @@ def main(args: argparse.Namespace) -> int:
 
     # Setup authenticated session for the script
     session = auth.setup_session()
+
+    # Report the update check even if logging in failed, as a newer version
+    # may be what fixes it
+    if update_check is not None:
+        update_checker.finish_update_check(update_check)
+
     if not session:
         logger.error("Could not setup authenticated session.")
         print(Fore.RED + "Could not setup authenticated session." + Fore.RESET)
         return 1
 
-    # Create an instance of the ExamProcessor to process exams
-    processor = ExamProcessor(session)
-
     # Loop through all pages of exams (search query: INFR) and process each one.
-    more_exams_exist = True
+    # The next page is scraped in the background while the current page's exams
+    # are being processed. Requests are paced by the exampapers rate limiter.
     page = 0
+    processor = None
     try:
-        while more_exams_exist:
+        try:
+            this_page_final, exams = scraper.scrape_exams_on_page(
+                session, page, args.academic_year
+            )
+        except Exception as e:
+            # Unexpired saved cookies are trusted without asking exampapers, but
+            # the server may have ended the session early. If that is why the
+            # first page failed, log in again and retry it once. If even the
+            # check fails, logging in again is still the best bet.
+            try:
+                authenticated = auth.is_exampapers_authenticated(session)
+            except Exception as check_error:
+                logger.debug(f"Could not check authentication: {check_error}")
+                authenticated = False
+            if authenticated:
+                raise e
+            logger.warning("Session is no longer authenticated, logging in again.")
+            session = auth.setup_session(trust_unexpired_cookies=False)
+            if not session:
+                raise Exception("Could not setup authenticated session.")
             this_page_final, exams = scraper.scrape_exams_on_page(
                 session, page, args.academic_year
             )
-            more_exams_exist = not this_page_final
+
+        # Create an instance of the ExamProcessor to process exams
+        processor = ExamProcessor(session)
+
+        while True:
             logger.info(
                 f"Processing page {page} with {len(exams)} downloadable exams. This page is {'' if this_page_final else 'not '}the last page."
             )
 
+            next_page = None
+            if not this_page_final:
+                next_page = Future()
+                Thread(
+                    target=scrape_next_page,
+                    args=(next_page, session, page + 1, args.academic_year),
+                    daemon=True,
+                ).start()
+
             processor.process_exams(exams, args.dry_run, args.continue_on_unknown_code)
 
-            if not this_page_final:
-                # Sleeping for 15 seconds to avoid rate-limiting
-                time.sleep(15)
+            if next_page is None:
+                return 0
+
+            this_page_final, exams = next_page.result()
             page += 1
-        return 0
     except Exception as e:
         print(Fore.RED + str(e) + Fore.RESET)
         exit(1)
+    finally:
+        # Don't let background work hold up exiting, such as on an error or
+        # Ctrl-C. The next page is scraped in a daemon thread, so that can be
+        # left as it is.
+        if processor is not None:
+            processor.close()
 
 
 if __name__ == "__main__":
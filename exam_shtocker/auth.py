@@ -5,20 +5,61 @@ import getpass
 import re
 import os
 import pickle
+import json
+import time
 import html
 
 import requests
 import requests.cookies
-from colorama import Style
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from colors import Style
 
-import selenium_controller
 from loader import Loader
 
 
 logger = logging.getLogger(__name__)
 
+# Number of hosts to keep connection pools for (exampapers, BI, BI's file
+# storage, EASE/Microsoft), and the number of keep-alive connections per host.
+# The latter must be at least the number of threads making requests to the same
+# host at once, or connections are thrown away and new TLS handshakes made.
+POOL_CONNECTIONS = 8
+POOL_MAXSIZE = 32
+
+# Retry idempotent requests on connection errors and on responses that are
+# likely to be transient, with exponential backoff (honouring Retry-After). POST
+# is not retried, as retrying an upload that did go through would duplicate it.
+RETRY = Retry(
+    total=5,
+    backoff_factor=1.0,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET", "HEAD"]),
+    raise_on_status=False,
+)
+
+# File the session cookies are kept in between runs. Older versions of the
+# script pickled the cookie jar here, newer ones write JSON, and both are read.
+SESSION_FILEPATH = "session_auth_pickle"
+
+# Host the session is authenticated with, whose cookies are kept and checked
+EXAMPAPERS_HOST = "exampapers.ed.ac.uk"
+
+# Saved exampapers cookies are trusted without checking with the server if none
+# of them expire within this many seconds
+COOKIE_EXPIRY_MARGIN = 60
+
+# Hidden inputs of the form that the IdP auto-submits to exampapers after login
+SAML_INPUT_REGEX = re.compile(
+    r'<input type="hidden" name="(SAMLResponse|RelayState)" value="([^"]*)"/>'
+)
+
 
 def perform_interactive_microsoft_login(session: requests.Session) -> Optional[str]:
+    # Selenium takes a noticeable time to import, and isn't needed at all when
+    # the saved cookies are still valid, so it is only imported here
+    import selenium_controller
+
     logger.info("Launching Selenium in background thread")
 
     # Launch selenium in a background thread and wait for the Microsoft login
@@ -76,6 +117,14 @@ def perform_interactive_microsoft_login(session: requests.Session) -> Optional[s
 
     loader.stop()
 
+    # Open a connection to exampapers while the user is busy with 2FA, so the
+    # request checking the cookies afterwards doesn't wait for a TLS handshake
+    Thread(
+        target=warm_up_connection,
+        args=(session, "https://exampapers.ed.ac.uk"),
+        daemon=True,
+    ).start()
+
     if prompt_type[0] == selenium_controller.TWO_FACTOR_TYPE.APPROVE_NUMBER:
         logger.debug("Prompting user to approve a number")
         print(f"Please use your app to approve this sign-in request: {prompt_type[1]}")
@@ -102,8 +151,7 @@ def perform_interactive_microsoft_login(session: requests.Session) -> Optional[s
         return None
 
     selenium_controller.copy_cookies_to_session(cookies, session)
-    r = session.get("https://exampapers.ed.ac.uk")
-    if "edadfed.ed.ac.uk" in r.url or "Sign In" in r.text:
+    if not is_exampapers_authenticated(session):
         logger.error("Retrieved Selenium cookies don't work with requests")
         loader.cancel("Retrieved cookies are invalid")
         return None
@@ -113,6 +161,110 @@ def perform_interactive_microsoft_login(session: requests.Session) -> Optional[s
     return name
 
 
+def is_exampapers_cookie_domain(domain: str) -> bool:
+    """Check whether a cookie set for the given domain would be sent to
+    exampapers, which includes cookies set for a parent domain such as
+    .ed.ac.uk, but not for a domain that merely ends in the same characters.
+
+    Parameters
+    ----------
+    domain : str
+        Domain attribute of the cookie, with or without a leading dot.
+
+    Returns
+    -------
+    bool
+        True if the cookie applies to exampapers, False otherwise.
+    """
+    domain = domain.lstrip(".")
+    return bool(domain) and (
+        EXAMPAPERS_HOST == domain or EXAMPAPERS_HOST.endswith("." + domain)
+    )
+
+
+def has_unexpired_exampapers_cookies(
+    cookies: requests.cookies.RequestsCookieJar,
+) -> bool:
+    """Check locally whether there are exampapers cookies that will all remain
+    valid for at least COOKIE_EXPIRY_MARGIN seconds. Session cookies without an
+    expiry time can't be judged this way, so their presence counts as unknown.
+
+    Parameters
+    ----------
+    cookies : requests.cookies.RequestsCookieJar
+        Cookies to check.
+
+    Returns
+    -------
+    bool
+        True if the cookies are known to be unexpired, False if they have
+        expired, are about to, or it can't be told.
+    """
+    exampapers_cookies = [
+        cookie for cookie in cookies if is_exampapers_cookie_domain(cookie.domain)
+    ]
+    if not exampapers_cookies:
+        return False
+
+    deadline = time.time() + COOKIE_EXPIRY_MARGIN
+    return all(
+        cookie.expires is not None and cookie.expires > deadline
+        for cookie in exampapers_cookies
+    )
+
+
+def is_exampapers_authenticated(session: requests.Session) -> bool:
+    """Check whether the session's cookies are logged into exampapers. The page
+    is only read if we were not already redirected to the login page.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session to check.
+
+    Returns
+    -------
+    bool
+        True if the session is logged in, False otherwise.
+    """
+    with session.get("https://exampapers.ed.ac.uk", stream=True) as r:
+        if "edadfed.ed.ac.uk" in r.url:
+            return False
+
+        # Search the raw bytes, skipping decoding (and charset detection)
+        return b"Sign In" not in r.content
+
+
+def warm_up_connection(session: requests.Session, url: str) -> None:
+    """Make a HEAD request to the given URL so that the session's connection pool
+    holds an open keep-alive connection to its host. The request goes straight
+    through the adapter, so that it can run alongside other uses of the session
+    without touching its cookies. Errors are ignored, as this is only an
+    optimisation.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session whose connection pool to warm up.
+    url : str
+        URL on the host to connect to.
+    """
+    try:
+        request = requests.Request("HEAD", url).prepare()
+        # Connections are pooled per TLS settings as well as host, so send with
+        # the same settings (such as a CA bundle from the environment) that the
+        # session's own requests will use, or they won't share the connection
+        settings = session.merge_environment_settings(url, {}, None, None, None)
+        r = session.get_adapter(url).send(request, timeout=10, **settings)
+        # Reading the (empty) body is what lets close() hand the connection back
+        # to the pool rather than dropping it
+        r.content
+        r.close()
+        logger.debug(f"Warmed up connection for {url}.")
+    except requests.RequestException as e:
+        logger.debug(f"Failed to warm up connection for {url}: {e}")
+
+
 def perform_interactive_ease_login(session: requests.Session) -> Optional[str]:
     """Perform EASE login and setup the session with the logged-in cookies, so
     that further requests using SAML will work.
@@ -169,24 +321,22 @@ def perform_exampapers_login(session: requests.Session) -> None:
     loader = Loader("Logging into ExamPapers...", "", 0.1).start()
     r = session.get("https://exampapers.ed.ac.uk")
 
-    saml_response = re.search(
-        r"<input type=\"hidden\" name=\"SAMLResponse\" value=\"(.*)\"/>", r.text
-    )
-    if not saml_response:
+    # Find both the SAMLResponse and RelayState input fields in one pass
+    fields = {m.group(1): m.group(2) for m in SAML_INPUT_REGEX.finditer(r.text)}
+
+    saml_response = fields.get("SAMLResponse")
+    if saml_response is None:
         raise Exception("Could not find SAMLResponse input field.")
 
-    saml_response = saml_response.group(1)
-    logger.debug(f"SAMLResponse: {saml_response}")
+    # Lazily formatted, as the SAMLResponse is a large base64 blob
+    logger.debug("SAMLResponse: %s", saml_response)
 
-    # Get the value of the RelayState input field
-    relay_state = re.search(
-        r"<input type=\"hidden\" name=\"RelayState\" value=\"(.*)\"/>", r.text
-    )
-    if not relay_state:
+    relay_state = fields.get("RelayState")
+    if relay_state is None:
         raise Exception("Could not find RelayState input field.")
 
-    relay_state = html.unescape(relay_state.group(1))
-    logger.debug(f"RelayState: {relay_state}")
+    relay_state = html.unescape(relay_state)
+    logger.debug("RelayState: %s", relay_state)
 
     # Login to ExamPapers
     logger.info("Sending exampapers the SAMLResponse...")
@@ -202,20 +352,99 @@ def perform_exampapers_login(session: requests.Session) -> None:
     loader.stop("Done.")
 
 
-def setup_session() -> Optional[requests.Session]:
-    loader = Loader("Setting up session...", "", 0.1).start()
+def create_session() -> requests.Session:
+    """Create a session with a connection pool large enough for the script's
+    concurrent requests, so that connections are kept alive and reused, and
+    that retries transient failures with backoff.
+
+    Returns
+    -------
+    requests.Session
+        New unauthenticated session.
+    """
     session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=RETRY,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
-    if os.path.exists("session_auth_pickle"):
-        loader.desc = "Using previous session_auth_pickle..."
-        with open("session_auth_pickle", "rb") as f:
-            cookies: requests.cookies.RequestsCookieJar = pickle.load(f)
-            session.cookies = cookies
+def save_cookies(cookies: requests.cookies.RequestsCookieJar, filepath: str) -> None:
+    """Save the cookies of a session to a JSON file, including the domain,
+    path and expiry of each cookie so that they are sent to the same places
+    when loaded again.
+
+    Parameters
+    ----------
+    cookies : requests.cookies.RequestsCookieJar
+        Cookies to save.
+    filepath : str
+        Path of the file to write.
+    """
+    with open(filepath, "w") as f:
+        json.dump(
+            [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                    "expires": cookie.expires,
+                    "secure": cookie.secure,
+                }
+                for cookie in cookies
+            ],
+            f,
+        )
+
+
+def load_cookies(filepath: str) -> requests.cookies.RequestsCookieJar:
+    """Load cookies saved by save_cookies. Cookie jars pickled by older versions
+    of the script are recognised by their header and still loaded.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the file to read.
+
+    Returns
+    -------
+    requests.cookies.RequestsCookieJar
+        The loaded cookies.
+    """
+    with open(filepath, "rb") as f:
+        contents = f.read()
+
+    # Pickles from protocol 2 onwards start with the PROTO opcode
+    if contents.startswith(b"\x80"):
+        logger.debug(f"Loading legacy pickled cookies from {filepath}.")
+        return pickle.loads(contents)
+
+    cookies = requests.cookies.RequestsCookieJar()
+    for cookie in json.loads(contents):
+        cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+    return cookies
+
+
+def setup_session(trust_unexpired_cookies: bool = True) -> Optional[requests.Session]:
+    loader = Loader("Setting up session...", "", 0.1).start()
+    session = create_session()
+
+    if os.path.exists(SESSION_FILEPATH):
+        loader.desc = f"Using previous {SESSION_FILEPATH}..."
+        session.cookies = load_cookies(SESSION_FILEPATH)
 
     loader.desc = "Checking if session is authenticated..."
-    # Try to get it on the first try, if it fails, try logging in
-    r = session.get("https://exampapers.ed.ac.uk")
-    if "edadfed.ed.ac.uk" in r.url or "Sign In" in r.text:
+    # Skip asking exampapers if the saved cookies are known to still be valid
+    # (unless the caller found out they aren't), otherwise try to get it on the
+    # first try, if it fails, try logging in
+    if trust_unexpired_cookies and has_unexpired_exampapers_cookies(session.cookies):
+        loader.stop("Session authenticated (cookies have not expired).")
+    elif not is_exampapers_authenticated(session):
         loader.cancel("Session needs login.")
 
         try:
@@ -232,8 +461,7 @@ def setup_session() -> Optional[requests.Session]:
 
     loader = Loader("Finalizing session setup...", "", 0.1).start()
 
-    with open("session_auth_pickle", "wb") as f:
-        pickle.dump(session.cookies, f)
+    save_cookies(session.cookies, SESSION_FILEPATH)
 
     loader.stop("Done.")
     return session
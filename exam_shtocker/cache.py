@@ -0,0 +1,335 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional, TypedDict
+
+from hashing import HASH_LENGTH
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILEPATH = "exam_shtocker_cache.sqlite"
+
+# Bump this whenever the schema or the meaning of the stored values changes, so
+# that caches created by older versions of the script are discarded.
+SCHEMA_VERSION = 5
+
+
+class CategoryHashes(TypedDict):
+    """Hashes of all exams in a BI category, along with the ETag and
+    Last-Modified headers of the exam list response they were calculated from.
+    """
+
+    hashes: set[bytes]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class CachedDownload(TypedDict):
+    """Hash of an exam downloaded from exampapers, along with the ETag and size
+    it had at the time, so that it can be recognised again without downloading.
+    """
+
+    etag: str
+    size: int
+    hash: bytes
+
+
+class CachedVersion(TypedDict):
+    """Latest version of the script as found by an update check, along with the
+    ETag of the version file it was read from and when it was checked.
+    """
+
+    version: str
+    etag: Optional[str]
+    checked_at: float
+
+
+class Cache:
+    """Persistent on-disk cache for data that is expensive to retrieve, such as
+    the BI category slugs of EUCLID codes, the hashes of all exams in a BI
+    category and of the individual exams on BI, the hashes of exams previously
+    downloaded from exampapers, or the latest version of the script. Safe to
+    use from multiple threads.
+    """
+
+    def __init__(self, filepath: str = CACHE_FILEPATH) -> None:
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+            if version != SCHEMA_VERSION:
+                logger.info(
+                    f"Discarding cache with schema version {version}, expected {SCHEMA_VERSION}."
+                )
+                tables = self.connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                ).fetchall()
+                for (table,) in tables:
+                    self.connection.execute(f"DROP TABLE {table}")
+                self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS category_slugs (
+                    euclid_code TEXT PRIMARY KEY,
+                    slug TEXT NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS category_hashes (
+                    euclid_code TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    hashes BLOB NOT NULL,
+                    fetched_at INTEGER NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS bi_exam_hashes (
+                    filename TEXT PRIMARY KEY,
+                    hash BLOB NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS download_hashes (
+                    download_url TEXT PRIMARY KEY,
+                    etag TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    hash BLOB NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS remote_versions (
+                    version_url TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    etag TEXT,
+                    checked_at REAL NOT NULL
+                )"""
+            )
+
+    def close(self) -> None:
+        """Close the connection to the cache database."""
+        with self.lock:
+            self.connection.close()
+
+    def get_category_slug(self, euclid_code: str) -> Optional[str]:
+        """Get the cached BI category slug for a given EUCLID code.
+
+        Parameters
+        ----------
+        euclid_code : str
+            EUCLID code of the course.
+
+        Returns
+        -------
+        Optional[str]
+            Better Informatics category slug, or None if not cached.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT slug FROM category_slugs WHERE euclid_code = ?",
+                (euclid_code,),
+            ).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_category_slug(self, euclid_code: str, slug: str) -> None:
+        """Store the BI category slug for a given EUCLID code.
+
+        Parameters
+        ----------
+        euclid_code : str
+            EUCLID code of the course.
+        slug : str
+            Better Informatics category slug.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO category_slugs VALUES (?, ?)",
+                (euclid_code, slug),
+            )
+
+    def get_category_hashes(self, euclid_code: str) -> Optional[CategoryHashes]:
+        """Get the cached hashes of all exams on BI for a given EUCLID code.
+
+        Parameters
+        ----------
+        euclid_code : str
+            EUCLID code of the course.
+
+        Returns
+        -------
+        Optional[CategoryHashes]
+            The cached hashes along with the ETag and Last-Modified headers of
+            the response they were calculated from, or None if not cached.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, last_modified, hashes FROM category_hashes WHERE euclid_code = ?",
+                (euclid_code,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        etag, last_modified, blob = row
+        return {
+            "hashes": {
+                blob[i : i + HASH_LENGTH] for i in range(0, len(blob), HASH_LENGTH)
+            },
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
+    def set_category_hashes(
+        self, euclid_code: str, category_hashes: CategoryHashes
+    ) -> None:
+        """Store the hashes of all exams on BI for a given EUCLID code.
+
+        Parameters
+        ----------
+        euclid_code : str
+            EUCLID code of the course.
+        category_hashes : CategoryHashes
+            Hashes to store, along with the ETag and Last-Modified headers of
+            the response they were calculated from.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO category_hashes VALUES (?, ?, ?, ?, ?)",
+                (
+                    euclid_code,
+                    category_hashes["etag"],
+                    category_hashes["last_modified"],
+                    b"".join(sorted(category_hashes["hashes"])),
+                    int(time.time()),
+                ),
+            )
+
+    def get_bi_exam_hash(self, filename: str) -> Optional[bytes]:
+        """Get the cached hash of an exam on BI.
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the exam on BI.
+
+        Returns
+        -------
+        Optional[bytes]
+            Hash of the exam, or None if not cached.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM bi_exam_hashes WHERE filename = ?", (filename,)
+            ).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_bi_exam_hash(self, filename: str, file_hash: bytes) -> None:
+        """Store the hash of an exam on BI.
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the exam on BI.
+        file_hash : bytes
+            Hash of the exam.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO bi_exam_hashes VALUES (?, ?)",
+                (filename, file_hash),
+            )
+
+    def get_download(self, download_url: str) -> Optional[CachedDownload]:
+        """Get the details of an exam previously downloaded from exampapers.
+
+        Parameters
+        ----------
+        download_url : str
+            URL the exam was downloaded from.
+
+        Returns
+        -------
+        Optional[CachedDownload]
+            Hash of the exam, along with the ETag and size it had when it was
+            downloaded, or None if it hasn't been downloaded before.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, size, hash FROM download_hashes WHERE download_url = ?",
+                (download_url,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        etag, size, file_hash = row
+        return {"etag": etag, "size": size, "hash": file_hash}
+
+    def set_download(self, download_url: str, download: CachedDownload) -> None:
+        """Store the details of an exam downloaded from exampapers.
+
+        Parameters
+        ----------
+        download_url : str
+            URL the exam was downloaded from.
+        download : CachedDownload
+            Hash of the exam, along with the ETag reported by the server and
+            the size of the exam in bytes.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO download_hashes VALUES (?, ?, ?, ?)",
+                (download_url, download["etag"], download["size"], download["hash"]),
+            )
+
+    def get_remote_version(self, version_url: str) -> Optional[CachedVersion]:
+        """Get the latest version of the script found by a previous update check.
+
+        Parameters
+        ----------
+        version_url : str
+            URL of the version file that was checked.
+
+        Returns
+        -------
+        Optional[CachedVersion]
+            The version, along with the ETag of the version file and when it
+            was checked, or None if it hasn't been checked before.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT version, etag, checked_at FROM remote_versions WHERE version_url = ?",
+                (version_url,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        version, etag, checked_at = row
+        return {"version": version, "etag": etag, "checked_at": checked_at}
+
+    def set_remote_version(self, version_url: str, version: CachedVersion) -> None:
+        """Store the latest version of the script found by an update check.
+
+        Parameters
+        ----------
+        version_url : str
+            URL of the version file that was checked.
+        version : CachedVersion
+            The version, along with the ETag of the version file and when it
+            was checked.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO remote_versions VALUES (?, ?, ?, ?)",
+                (
+                    version_url,
+                    version["version"],
+                    version["etag"],
+                    version["checked_at"],
+                ),
+            )
@@ -0,0 +1,17 @@
+import sys
+from types import SimpleNamespace
+
+# Only colour the output when it is shown in a terminal. When it is piped or
+# redirected to a file, plain strings are used instead of ANSI escape codes,
+# and colorama isn't imported at all.
+OUTPUT_IS_TTY = sys.stdout.isatty()
+
+if OUTPUT_IS_TTY:
+    from colorama import Fore, Style, just_fix_windows_console
+
+    # Make older Windows consoles understand ANSI codes, both colours and the
+    # line clearing done by the loader. Does nothing on other platforms.
+    just_fix_windows_console()
+else:
+    Fore = SimpleNamespace(RED="", GREEN="", YELLOW="", RESET="")
+    Style = SimpleNamespace(BRIGHT="", RESET_ALL="")
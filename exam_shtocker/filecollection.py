@@ -1,10 +1,15 @@
 import requests
-from typing import Optional
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import Any, BinaryIO, Optional
+import hashing
+import io
 import os
+import uuid
 import logging
 import re
 import pypdf
+from cache import Cache, CategoryHashes
 
 logger = logging.getLogger(__name__)
 
@@ -12,11 +17,33 @@ bi_api_key = os.environ.get("BI_API_KEY")
 if bi_api_key is None:
     raise Exception("BI_API_KEY environment variable not set.")
 
+# Headers authenticating requests to the BI API
+BI_API_HEADERS = {"X-COMMUNITY-SOLUTIONS-API-KEY": bi_api_key}
+
+# Maximum number of exams in a category to download from BI at the same time
+CATEGORY_DOWNLOAD_CONCURRENCY = 8
+
+# Size of the chunks exams are hashed in as they are downloaded from BI
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Exam diets in the format "Month Year", optionally with a day in between, such
+# as "May 2021" or "December 12, 2019"
+DIET_REGEX = re.compile(
+    r"(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|Jun(?:e)?|Jul(?:y)?|Aug(?:ust)?|Sep(?:tember)?|Oct(?:ober)?|(Nov|Dec)(?:ember)?)\D?(\d{1,2}\D?)?\D?((19[7-9]\d|20\d{2})|\d{2})",
+    re.ASCII,
+)
+
+# Category slugs already looked up in this run, keyed by EUCLID code. The slug
+# is needed once when fetching hashes and again for every upload to the course.
+slug_cache: dict[str, str] = {}
+
 
 def get_category_slug_for_euclid_code(
-    session: requests.Session, euclid_code: str
+    session: requests.Session, euclid_code: str, cache: Optional[Cache] = None
 ) -> str:
-    """Get the Better Informatics category slug for a given EUCLID code.
+    """Get the Better Informatics category slug for a given EUCLID code. Slugs
+    are remembered for the rest of the run, and if a cache is provided, across
+    runs too.
 
     Parameters
     ----------
@@ -24,6 +51,8 @@ def get_category_slug_for_euclid_code(
         Session to use for the request.
     euclid_code : str
         EUCLID code of the course.
+    cache : Optional[Cache]
+        Cache of category slugs.
 
     Returns
     -------
@@ -36,6 +65,15 @@ def get_category_slug_for_euclid_code(
         If the request fails, for example if the EUCLID code is invalid or if no
         category was found on BI matching the provided EUCLID code.
     """
+    if euclid_code in slug_cache:
+        return slug_cache[euclid_code]
+
+    if cache is not None:
+        slug = cache.get_category_slug(euclid_code)
+        if slug is not None:
+            slug_cache[euclid_code] = slug
+            return slug
+
     # Does not need login
     r = session.get(
         f"https://files.betterinformatics.com/api/category/slugfromeuclidcode?code={euclid_code}"
@@ -45,14 +83,31 @@ def get_category_slug_for_euclid_code(
             f"Failed ({r.status_code}) to get slug for EUCLID code: {euclid_code}"
         )
 
-    return r.json()["value"]
+    slug = r.json()["value"]
+    slug_cache[euclid_code] = slug
+    if cache is not None:
+        cache.set_category_slug(euclid_code, slug)
 
+    return slug
 
-def get_hashes_for_category(session: requests.Session, slug: str) -> list[bytes]:
+
+def get_hashes_for_category(
+    session: requests.Session,
+    slug: str,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    cache: Optional[Cache] = None,
+    stop: Optional[Event] = None,
+) -> Optional[CategoryHashes]:
     """Retrieve the hashes of all exams in a given Better Informatics category.
     Requires the `BI_API_KEY` environment variable to be set with the BI API
     key defined in the BI container manifest (e.g. docker-compose.yaml or k8s).
 
+    If the ETag or Last-Modified values of a previous response are provided,
+    the exam list is requested conditionally, and nothing is downloaded if it
+    has not changed since. If a cache is provided, exams whose hashes were
+    calculated on a previous run are not downloaded again either.
+
     Parameters
     ----------
     session : requests.Session
@@ -60,11 +115,21 @@ def get_hashes_for_category(session: requests.Session, slug: str) -> list[bytes]
     slug : str
         Slug of the category to get the hashes for. Use
         get_category_slug_for_euclid_code to get the slug for a given code.
+    etag : Optional[str]
+        ETag of a previous exam list response for this category.
+    last_modified : Optional[str]
+        Last-Modified header of a previous exam list response for this category.
+    cache : Optional[Cache]
+        Cache of the hashes of individual exams on BI.
+    stop : Optional[Event]
+        If given, downloading the exams is abandoned once this is set.
 
     Returns
     -------
-    list[bytes]
-        List of file hashes for all exams in the category.
+    Optional[CategoryHashes]
+        Hashes for all exams in the category, along with the ETag and
+        Last-Modified headers of the exam list response. None if the exam list
+        has not been modified since the provided ETag or Last-Modified.
 
     Raises
     ------
@@ -73,41 +138,122 @@ def get_hashes_for_category(session: requests.Session, slug: str) -> list[bytes]
     Exception
         If the request fails, for example if the category slug is invalid.
     Exception
-        If the download of an exam fails.
+        If the download of an exam fails or is stopped.
     """
     logger.debug(f"Getting exam list for category {slug}...")
 
+    headers = dict(BI_API_HEADERS)
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+
     # Requires login
     r = session.get(
         f"https://files.betterinformatics.com/api/category/listexams/{slug}/",
-        headers={"X-COMMUNITY-SOLUTIONS-API-KEY": bi_api_key},
+        headers=headers,
     )
+    if r.status_code == 304:
+        logger.debug(f"Exam list for category {slug} has not been modified.")
+        return None
     if r.status_code != 200:
         raise Exception(
             f"Failed ({r.status_code}) to get exam list for category: {slug}."
         )
 
-    hashes: list[bytes] = []
-    for exam_file in r.json()["value"]:
-        logger.debug(
-            f"Downloading {exam_file['category_displayname']} {exam_file['displayname']} ({exam_file['filename']})..."
+    list_etag = r.headers.get("ETag")
+    list_last_modified = r.headers.get("Last-Modified")
+
+    with ThreadPoolExecutor(max_workers=CATEGORY_DOWNLOAD_CONCURRENCY) as executor:
+        hashes = set(
+            executor.map(
+                lambda exam_file: download_and_hash_exam(
+                    session, exam_file, cache, stop
+                ),
+                r.json()["value"],
+            )
         )
-        r = session.get(
-            f"https://files.betterinformatics.com/api/exam/pdf/exam/{exam_file['filename']}/",
-            headers={"X-COMMUNITY-SOLUTIONS-API-KEY": bi_api_key},
+
+    logger.debug(f"Got {len(hashes)} hashes.")
+    return {
+        "hashes": hashes,
+        "etag": list_etag,
+        "last_modified": list_last_modified,
+    }
+
+
+def download_and_hash_exam(
+    session: requests.Session,
+    exam_file: dict[str, Any],
+    cache: Optional[Cache] = None,
+    stop: Optional[Event] = None,
+) -> bytes:
+    """Download an exam from Better Informatics and calculate its hash. Files on
+    BI are never modified in place, so if a cache is provided, the hash is
+    looked up there by filename first and stored there once calculated.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session to use for the request.
+    exam_file : dict[str, Any]
+        Exam as listed by the category listexams API.
+    cache : Optional[Cache]
+        Cache of the hashes of individual exams on BI.
+    stop : Optional[Event]
+        If given, the download is abandoned once this is set.
+
+    Returns
+    -------
+    bytes
+        Hash of the exam PDF.
+
+    Raises
+    ------
+    Exception
+        If the download of the exam fails or is stopped.
+    """
+    if cache is not None:
+        file_hash = cache.get_bi_exam_hash(exam_file["filename"])
+        if file_hash is not None:
+            return file_hash
+
+    if stop is not None and stop.is_set():
+        raise Exception(f"Stopped downloading exam {exam_file['filename']}.")
+
+    logger.debug(
+        "Downloading %s %s (%s)...",
+        exam_file["category_displayname"],
+        exam_file["displayname"],
+        exam_file["filename"],
+    )
+    r = session.get(
+        f"https://files.betterinformatics.com/api/exam/pdf/exam/{exam_file['filename']}/",
+        headers=BI_API_HEADERS,
+    )
+    if r.status_code != 200:
+        raise Exception(
+            f"Failed ({r.status_code}) to download exam {exam_file['filename']}."
         )
+
+    # Hash the file as it arrives rather than holding all of it in memory
+    hasher = hashing.new_hasher()
+    with session.get(r.json()["value"], stream=True) as r:
+        # Never hash (and cache) an error page in place of the exam
         if r.status_code != 200:
             raise Exception(
-                f"Failed ({r.status_code}) to download exam {exam_file['filename']}."
+                f"Failed ({r.status_code}) to download exam {exam_file['filename']} from storage."
             )
+        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+            if stop is not None and stop.is_set():
+                raise Exception(f"Stopped downloading exam {exam_file['filename']}.")
+            hasher.update(chunk)
 
-        contents = session.get(r.json()["value"]).content
-
-        # Return the hash of the file
-        hashes.append(hashlib.sha256(contents).digest())
+    file_hash = hasher.digest()
+    if cache is not None:
+        cache.set_bi_exam_hash(exam_file["filename"], file_hash)
 
-    logger.debug(f"Got {len(hashes)} hashes.")
-    return hashes
+    return file_hash
 
 
 def try_parse_exam_pdf_diet(pdf_filepath: str) -> Optional[str]:
@@ -125,17 +271,81 @@ def try_parse_exam_pdf_diet(pdf_filepath: str) -> Optional[str]:
         Extracted exam diet if found, None otherwise.
     """
     pdf_reader = pypdf.PdfReader(pdf_filepath)
-    text = pdf_reader.pages[0].extract_text()
-    match = re.search(
-        r"(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|Jun(?:e)?|Jul(?:y)?|Aug(?:ust)?|Sep(?:tember)?|Oct(?:ober)?|(Nov|Dec)(?:ember)?)\D?(\d{1,2}\D?)?\D?((19[7-9]\d|20\d{2})|\d{2})",
-        text,
-    )
+    # The diet is printed upright on the cover, so skip extracting rotated text
+    text = pdf_reader.pages[0].extract_text(orientations=(0,))
+    match = DIET_REGEX.search(text)
     if match:
         return match.group(0)
 
     return None
 
 
+class MultipartUploadBody:
+    """File-like multipart/form-data request body for uploading a single file
+    along with some text fields. Unlike requests' `files=` argument, which
+    builds the whole body in memory, the file is read from disk in pieces as
+    the body is sent. The length is known upfront, so requests still sends a
+    Content-Length header rather than using chunked encoding.
+    """
+
+    def __init__(self, fields: dict[str, str], file_field: str, filepath: str) -> None:
+        """
+        Parameters
+        ----------
+        fields : dict[str, str]
+            Text fields to send, by name.
+        file_field : str
+            Name of the field to send the file as.
+        filepath : str
+            Path to the file to send.
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        head = "".join(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+            for name, value in fields.items()
+        )
+        head += (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{os.path.basename(filepath)}"\r\n'
+            f"Content-Type: application/pdf\r\n\r\n"
+        )
+        head_bytes = head.encode()
+        tail_bytes = f"\r\n--{boundary}--\r\n".encode()
+
+        self.parts: list[BinaryIO] = [
+            io.BytesIO(head_bytes),
+            open(filepath, "rb"),
+            io.BytesIO(tail_bytes),
+        ]
+        self.length = len(head_bytes) + os.path.getsize(filepath) + len(tail_bytes)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self.parts and (size < 0 or size > 0):
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0).close()
+                continue
+
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        for part in self.parts:
+            part.close()
+        self.parts = []
+
+
 def upload_exam(session: requests.Session, euclid_code: str, filepath: str) -> str:
     """Upload an exam PDF to Better Informatics under the category matching the
     given EUCLID code.
@@ -170,21 +380,28 @@ def upload_exam(session: requests.Session, euclid_code: str, filepath: str) -> s
     # Get the upload page to get the CSRF token in the cookies
     r = session.get("https://files.betterinformatics.com/uploadpdf/")
 
-    with open(filepath, "rb") as file:
+    body = MultipartUploadBody(
+        {
+            "category": slug,
+            "displayname": diet or f"{euclid_code} - Unknown diet",
+        },
+        "file",
+        filepath,
+    )
+    try:
         r = session.post(
             f"https://files.betterinformatics.com/api/exam/upload/exam/",
             headers={
-                "X-COMMUNITY-SOLUTIONS-API-KEY": os.environ["BI_API_KEY"],
+                **BI_API_HEADERS,
                 "X-CSRFToken": session.cookies["csrftoken"],
                 # Referer needed to pass the CSRF check in addition to cookies
                 "Referer": f"https://files.betterinformatics.com/uploadpdf/",
+                "Content-Type": body.content_type,
             },
-            data={
-                "category": slug,
-                "displayname": diet or f"{euclid_code} - Unknown diet",
-            },
-            files={"file": file},
+            data=body,
         )
+    finally:
+        body.close()
     if r.status_code != 200:
         raise Exception(f"Failed to upload {filepath} for {euclid_code}: {r.text}")
 
@@ -0,0 +1,21 @@
+import hashlib
+
+# Algorithm used to fingerprint exam PDFs for deduplication. Both sides of every
+# comparison are hashed locally, but the digests in known_bads.known_bad_hashes
+# and in the on-disk cache must use the same algorithm, so changing this means
+# rehashing those and bumping cache.SCHEMA_VERSION.
+HASH_ALGORITHM = "sha256"
+
+# Length of each hash in bytes
+HASH_LENGTH = hashlib.new(HASH_ALGORITHM).digest_size
+
+
+def new_hasher() -> "hashlib._Hash":
+    """Create a new hash object for fingerprinting exam PDFs.
+
+    Returns
+    -------
+    hashlib._Hash
+        Empty hash object using HASH_ALGORITHM.
+    """
+    return hashlib.new(HASH_ALGORITHM)
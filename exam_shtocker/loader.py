@@ -1,8 +1,15 @@
-from threading import Thread
+from threading import Event, Thread
 from itertools import cycle
-from time import sleep
 from shutil import get_terminal_size
-from colorama import Fore
+from colors import Fore, OUTPUT_IS_TTY
+
+# Written before each line to replace what was previously on it. In a terminal
+# this is the ANSI "erase line" code; otherwise, the line is overwritten with as
+# many spaces as the (fallback) width, which can't change while running.
+if OUTPUT_IS_TTY:
+    CLEAR_LINE = "\r\x1b[2K\r"
+else:
+    CLEAR_LINE = "\r" + " " * get_terminal_size((80, 20)).columns + "\r"
 
 
 class Loader:
@@ -23,7 +30,9 @@ class Loader:
 
         self._thread = Thread(target=self._animate, daemon=True)
         self.steps = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
-        self.done = False
+        # Set to stop the animation; waiting on it instead of sleeping means the
+        # animation thread wakes up and exits as soon as the loader is stopped
+        self._stopped = Event()
 
     def start(self):
         self._thread.start()
@@ -31,31 +40,32 @@ class Loader:
 
     def _animate(self):
         for c in cycle(self.steps):
-            if self.done:
+            if self._stopped.is_set():
                 break
-            cols = get_terminal_size((80, 20)).columns
-            print("\r" + " " * cols, end="", flush=True)
-            print(f"\r{c} {self.desc}", flush=True, end="")
-            sleep(self.timeout)
+            print(f"{CLEAR_LINE}{c} {self.desc}", flush=True, end="")
+            self._stopped.wait(self.timeout)
 
     def __enter__(self):
         self.start()
 
+    def _halt(self):
+        # Wait for the animation thread to exit, so that it can't draw another
+        # frame over the final line
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
     def cancel(self, end: str = "Failed!"):
-        self.done = True
-        cols = get_terminal_size((80, 20)).columns
-        print("\r" + " " * cols, end="", flush=True)
+        self._halt()
         print(
-            f"\r{Fore.RED}⨯{Fore.RESET} {self.desc} {Fore.RED}{end}{Fore.RESET}",
+            f"{CLEAR_LINE}{Fore.RED}⨯{Fore.RESET} {self.desc} {Fore.RED}{end}{Fore.RESET}",
             flush=True,
         )
 
     def stop(self, end: str = "Done!"):
-        self.done = True
-        cols = get_terminal_size((80, 20)).columns
-        print("\r" + " " * cols, end="", flush=True)
+        self._halt()
         print(
-            f"\r{Fore.GREEN}✓{Fore.RESET} {self.desc} {Fore.GREEN}{end}{Fore.RESET}",
+            f"{CLEAR_LINE}{Fore.GREEN}✓{Fore.RESET} {self.desc} {Fore.GREEN}{end}{Fore.RESET}",
             flush=True,
         )
 
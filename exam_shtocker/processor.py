@@ -1,32 +1,147 @@
-import hashlib
+import atexit
 import os
-import random
-import time
+import shutil
+import uuid
 import requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event
 from loader import Loader
 import logging
 import filecollection
+import hashing
+from cache import Cache
 import known_bads
+from rate_limiter import exampapers_limiter
 import scraper
 import tempfile
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of exams to download from exampapers at the same time. The
+# request rate itself is capped by exampapers_limiter, so that the account isn't
+# flagged for abuse.
+DOWNLOAD_CONCURRENCY = 4
+
+# Maximum number of BI categories to fetch the hashes of at the same time
+HASH_PREFETCH_CONCURRENCY = 4
+
+# Size of the chunks in which exams are streamed to disk and hashed
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+    """Raised when an exam can't be downloaded from exampapers. Only that exam
+    is skipped, rather than stopping the whole run.
+    """
+
 
 class ExamProcessor:
     session: requests.Session
-    uploaded_hashes_by_euclid_code: dict[str, list[bytes]]
+    uploaded_hashes_by_euclid_code: dict[str, set[bytes]]
+    hash_prefetcher: ThreadPoolExecutor
+    hash_prefetches: dict[str, Future[set[bytes]]]
+    stopping: Event
+    cache: Cache
+    scratch_dir: str
 
     loader = None
 
     def __init__(self, session: requests.Session) -> None:
         self.session = session
         self.uploaded_hashes_by_euclid_code = {}
+        self.cache = Cache()
+
+        # Exams are downloaded into a single scratch directory, which is removed
+        # along with anything left in it when the script exits
+        self.scratch_dir = tempfile.mkdtemp(prefix="examshtocker-")
+        atexit.register(shutil.rmtree, self.scratch_dir, ignore_errors=True)
+        self.hash_prefetcher = ThreadPoolExecutor(
+            max_workers=HASH_PREFETCH_CONCURRENCY
+        )
+        self.hash_prefetches = {}
+        # Set to make downloads that are still running give up, so that they
+        # don't hold up exiting
+        self.stopping = Event()
+
+    def close(self) -> None:
+        """Stop fetching hashes and downloading exams in the background. Work
+        that hasn't started is cancelled, and running downloads give up at the
+        next chunk without being waited for.
+        """
+        self.stopping.set()
+        self.hash_prefetcher.shutdown(wait=False, cancel_futures=True)
+
+    def fetch_hashes_for_euclid_code(self, euclid_code: str) -> set[bytes]:
+        """Download all files in the BI category matching the given EUCLID code
+        and calculate their hashes. Hashes from previous runs are cached on
+        disk, and only recalculated if BI reports that the category's exam list
+        has changed. This does not touch the loader, so that it can be run in
+        the background.
+
+        Parameters
+        ----------
+        euclid_code : str
+            EUCLID code to get the hashes for.
+
+        Returns
+        -------
+        set[bytes]
+            Set of hashes of all exams for the given EUCLID code on BI.
+        """
+        logger.debug(f"Determining BI slug for {euclid_code}...")
+        slug = filecollection.get_category_slug_for_euclid_code(
+            self.session, euclid_code, self.cache
+        )
+
+        cached = self.cache.get_category_hashes(euclid_code)
+        if cached is None:
+            logger.debug(f"Downloading and calculating hashes for {str(slug)}...")
+            category_hashes = filecollection.get_hashes_for_category(
+                self.session, slug, cache=self.cache, stop=self.stopping
+            )
+        else:
+            logger.debug(f"Checking if cached hashes for {str(slug)} are valid...")
+            category_hashes = filecollection.get_hashes_for_category(
+                self.session,
+                slug,
+                cached["etag"],
+                cached["last_modified"],
+                cache=self.cache,
+                stop=self.stopping,
+            )
 
-    def get_hashes_for_euclid_code(self, euclid_code: str) -> list[bytes]:
+        if category_hashes is None:
+            assert cached is not None
+            logger.debug(f"Using {len(cached['hashes'])} cached hashes for {slug}.")
+            return cached["hashes"]
+
+        self.cache.set_category_hashes(euclid_code, category_hashes)
+        return category_hashes["hashes"]
+
+    def prefetch_hashes_for_euclid_code(self, euclid_code: str) -> None:
+        """Start fetching the hashes for a given EUCLID code in the background,
+        unless they are already known or being fetched.
+
+        Parameters
+        ----------
+        euclid_code : str
+            EUCLID code to get the hashes for.
+        """
+        if (
+            euclid_code in self.uploaded_hashes_by_euclid_code
+            or euclid_code in self.hash_prefetches
+        ):
+            return
+
+        self.hash_prefetches[euclid_code] = self.hash_prefetcher.submit(
+            self.fetch_hashes_for_euclid_code, euclid_code
+        )
+
+    def get_hashes_for_euclid_code(self, euclid_code: str) -> set[bytes]:
         """Get the hashes of all exams for a given EUCLID code that have been
-        uploaded. If this is unknown, the function will download all files in
-        the category and store the hashes.
+        uploaded. If this is unknown, the function will wait for all files in
+        the category to be downloaded (in the background) and store the hashes.
 
         Parameters
         ----------
@@ -35,25 +150,18 @@ class ExamProcessor:
 
         Returns
         -------
-        list[bytes]
-            List of hashes of all exams for the given EUCLID code that have been
+        set[bytes]
+            Set of hashes of all exams for the given EUCLID code that have been
             uploaded.
         """
         assert self.loader is not None
 
         if euclid_code not in self.uploaded_hashes_by_euclid_code:
-            logger.debug(f"Determining BI slug for {euclid_code}...")
-            self.loader.desc = f"Determining BI slug for {euclid_code}..."
-
-            slug = filecollection.get_category_slug_for_euclid_code(
-                self.session, euclid_code
-            )
-
-            logger.debug(f"Downloading and calculating hashes for {str(slug)}...")
-            self.loader.desc = f"Calculating hashes for {slug}..."
+            self.prefetch_hashes_for_euclid_code(euclid_code)
+            self.loader.desc = f"Calculating hashes for {euclid_code}..."
 
             self.uploaded_hashes_by_euclid_code[euclid_code] = (
-                filecollection.get_hashes_for_category(self.session, slug)
+                self.hash_prefetches.pop(euclid_code).result()
             )
 
         return self.uploaded_hashes_by_euclid_code[euclid_code]
@@ -80,89 +188,145 @@ class ExamProcessor:
             prefixes is provided, the function will skip any exam with a prefix
             in the list and error on any other unknown code.
         """
-        for i, exam in enumerate(exams):
-            i_str = f"{i + 1}/{len(exams)}"
-            if self.loader is None:
-                self.loader = Loader(f"{i_str} Waiting...", "", 0.1).start()
-            else:
-                self.loader.desc = f"{i_str} Waiting..."
-
-            # Sleep for up to 5 seconds between each exam to avoid having
-            # ease account being flagged for abuse
-            time.sleep(random.randint(1, 5))
-
-            logger.info(f"{i_str} Processing exam: {exam}")
-            self.loader.desc = (
-                f"{i_str} Downloading {exam.euclid_code}: {exam.title}..."
-            )
+        # Start fetching the hashes of exams already on BI for each code on
+        # this page in parallel, in the order they will be needed
+        for exam in exams:
+            self.prefetch_hashes_for_euclid_code(exam.euclid_code)
+
+        # Start downloading exams in the background, a few at a time, so that
+        # downloads overlap with the hash checks and uploads below
+        executor = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY)
+        downloads = [executor.submit(self.download_exam, exam) for exam in exams]
 
-            # First, download the exam to a temporary directory and calculate
-            # its file hash
-            downloaded_filepath, file_hash = self.download_exam(exam)
-            logger.info(f"{i_str} Hash: {file_hash.hex()}")
+        i = -1
+        try:
+            for i, (exam, download) in enumerate(zip(exams, downloads)):
+                i_str = f"{i + 1}/{len(exams)}"
+                if self.loader is None:
+                    self.loader = Loader(f"{i_str} Waiting...", "", 0.1).start()
+                else:
+                    self.loader.desc = f"{i_str} Waiting..."
 
-            # Check if this is a known bad hash
-            if file_hash in known_bads.known_bad_hashes:
-                logger.info(
-                    f"Skipping {exam.euclid_code}: {exam.title} due to known bad hash."
+                logger.info(f"{i_str} Processing exam: {exam}")
+                self.loader.desc = (
+                    f"{i_str} Downloading {exam.euclid_code}: {exam.title}..."
                 )
-                os.remove(downloaded_filepath)
-                continue
 
-            # Check if the file has already been uploaded by comparing against
-            # the hashes of all exams for the EUCLID code on BI
-            try:
-                if file_hash in self.get_hashes_for_euclid_code(exam.euclid_code):
-                    logger.info(f"Skipping upload: Already exists.")
-                    os.remove(downloaded_filepath)
-                    # We reuse the same loader instance, so we don't set self.loader = None
+                # First, wait for the exam to be downloaded to a temporary
+                # directory and its file hash calculated
+                try:
+                    downloaded_filepath, file_hash = download.result()
+                except DownloadError as e:
+                    logger.error(f"{i_str} {e}")
+                    self.loader.cancel(f"Skipping: {e}")
+                    self.loader = None
                     continue
-            except Exception as e:
-                if continue_on_unknown_code is not None:
-                    # If we are continuing on unknown codes, we skip this exam
-                    if any(
-                        exam.euclid_code.startswith(prefix)
-                        for prefix in continue_on_unknown_code
-                    ):
-                        logger.warning(
-                            f"Skipping {exam.euclid_code}: {exam.title} due to code matching known continuation prefixes."
-                        )
-                        if (
-                            len(continue_on_unknown_code) == 1
-                            and continue_on_unknown_code[0] == ""
+                logger.info(f"{i_str} Hash: {file_hash.hex()}")
+
+                # Check if this is a known bad hash
+                if file_hash in known_bads.known_bad_hashes:
+                    logger.info(
+                        f"Skipping {exam.euclid_code}: {exam.title} due to known bad hash."
+                    )
+                    self.discard_download(downloaded_filepath)
+                    continue
+
+                # Check if the file has already been uploaded by comparing against
+                # the hashes of all exams for the EUCLID code on BI
+                try:
+                    if file_hash in self.get_hashes_for_euclid_code(exam.euclid_code):
+                        logger.info(f"Skipping upload: Already exists.")
+                        self.discard_download(downloaded_filepath)
+                        # We reuse the same loader instance, so we don't set self.loader = None
+                        continue
+                except Exception as e:
+                    if continue_on_unknown_code is not None:
+                        # If we are continuing on unknown codes, we skip this exam
+                        if any(
+                            exam.euclid_code.startswith(prefix)
+                            for prefix in continue_on_unknown_code
                         ):
-                            # If the user specified continuation but without any prefixes,
-                            # warn explicitly that it was skipped. But if they gave prefixes,
-                            # silently skip.
-                            self.loader.stop(
-                                f"Skipping: {exam.euclid_code} {exam.title} does not exist on BI and --continue-on-unknown-code provided. Provide an explicit skip prefix to hide this message."
+                            logger.warning(
+                                f"Skipping {exam.euclid_code}: {exam.title} due to code matching known continuation prefixes."
                             )
-                            self.loader = None
-                        os.remove(downloaded_filepath)
+                            if (
+                                len(continue_on_unknown_code) == 1
+                                and continue_on_unknown_code[0] == ""
+                            ):
+                                # If the user specified continuation but without any prefixes,
+                                # warn explicitly that it was skipped. But if they gave prefixes,
+                                # silently skip.
+                                self.loader.stop(
+                                    f"Skipping: {exam.euclid_code} {exam.title} does not exist on BI and --continue-on-unknown-code provided. Provide an explicit skip prefix to hide this message."
+                                )
+                                self.loader = None
+                            self.discard_download(downloaded_filepath)
+                            continue
+                    raise e
+
+                # Upload the file
+                logger.debug(f"{i_str} Uploading to BI...")
+                self.loader.desc = f"{i_str} Uploading {exam.title} ({exam.year})..."
+                if dry_run:
+                    logger.info(f"Skipping upload: Dry run.")
+                    self.loader.stop(
+                        f"Skipping: Dry run. To upload, run without --dry-run."
+                    )
+                    self.loader = None
+                    self.discard_download(downloaded_filepath)
+                    continue
+
+                # The exam isn't downloaded if its hash was already known from a
+                # previous run, but it's needed for uploading
+                if downloaded_filepath is None:
+                    self.loader.desc = f"{i_str} Downloading {exam.title} ({exam.year})..."
+                    try:
+                        downloaded_filepath, file_hash = self.download_exam(
+                            exam, use_cache=False
+                        )
+                    except DownloadError as e:
+                        logger.error(f"{i_str} {e}")
+                        self.loader.cancel(f"Skipping: {e}")
+                        self.loader = None
                         continue
-                raise e
-
-            # Upload the file
-            logger.debug(f"{i_str} Uploading to BI...")
-            self.loader.desc = f"{i_str} Uploading {exam.title} ({exam.year})..."
-            if dry_run:
-                logger.info(f"Skipping upload: Dry run.")
-                self.loader.stop(
-                    f"Skipping: Dry run. To upload, run without --dry-run."
-                )
-                self.loader = None
-                continue
 
-            url = filecollection.upload_exam(
-                self.session, exam.euclid_code, downloaded_filepath
-            )
+                    # The exam may have changed since the hash checked above was
+                    # calculated, so check the file that will be uploaded again
+                    uploaded = self.get_hashes_for_euclid_code(exam.euclid_code)
+                    if (
+                        file_hash in known_bads.known_bad_hashes
+                        or file_hash in uploaded
+                    ):
+                        logger.info(
+                            f"Skipping upload: Changed exam is a known bad or already exists."
+                        )
+                        self.discard_download(downloaded_filepath)
+                        continue
 
-            # Add the hash to the list of uploaded hashes
-            self.uploaded_hashes_by_euclid_code[exam.euclid_code].append(file_hash)
+                    self.loader.desc = f"{i_str} Uploading {exam.title} ({exam.year})..."
 
-            # Show a completed line that remains on screen by stopping the loader
-            self.loader.stop(f"Done ({url}).")
-            self.loader = None
+                url = filecollection.upload_exam(
+                    self.session, exam.euclid_code, downloaded_filepath
+                )
+
+                # Add the hash to the set of uploaded hashes, and remember it
+                # under its new BI filename so the next run, which will see the
+                # category's exam list changed, doesn't download it back
+                self.uploaded_hashes_by_euclid_code[exam.euclid_code].add(file_hash)
+                self.cache.set_bi_exam_hash(url.rsplit("/", 1)[-1], file_hash)
+
+                # Show a completed line that remains on screen by stopping the loader
+                self.loader.stop(f"Done ({url}).")
+                self.loader = None
+        except BaseException:
+            # The run is ending, so stop the downloads still running rather than
+            # waiting for them, and don't leave behind temporary files for exams
+            # that were downloaded but never processed
+            self.stopping.set()
+            self.discard_downloads(downloads[i + 1 :])
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
         # Loader must be stopped after processing all exams or else it will try
         # to conflict with the next page's scraping loader
@@ -171,28 +335,121 @@ class ExamProcessor:
             self.loader.stop("")
             self.loader = None
 
-    def download_exam(self, exam: scraper.Exam) -> tuple[str, bytes]:
-        """Given an Exam object, download the exam from exampapers to a
-        temporary file and return the file path and hash.
+    def discard_download(self, downloaded_filepath: Optional[str]) -> None:
+        """Remove the temporary file of a downloaded exam, if there is one.
+
+        Parameters
+        ----------
+        downloaded_filepath : Optional[str]
+            File path returned by download_exam.
+        """
+        if downloaded_filepath is not None:
+            os.remove(downloaded_filepath)
+
+    def discard_downloads(
+        self, downloads: list[Future[tuple[Optional[str], bytes]]]
+    ) -> None:
+        """Cancel exam downloads that have not started yet, and remove the
+        temporary files of any that have already finished. Downloads that are
+        still running are not waited for, and their files are left to be
+        removed along with the scratch directory.
+
+        Parameters
+        ----------
+        downloads : list[Future[tuple[Optional[str], bytes]]]
+            Futures returned by submitting download_exam.
+        """
+        for download in downloads:
+            if download.cancel() or not download.done():
+                continue
+            try:
+                downloaded_filepath, _ = download.result()
+            except Exception:
+                continue
+            self.discard_download(downloaded_filepath)
+
+    def download_exam(
+        self, exam: scraper.Exam, use_cache: bool = True
+    ) -> tuple[Optional[str], bytes]:
+        """Given an Exam object, download the exam from exampapers to a file in
+        the scratch directory and return the file path and hash. The file is streamed
+        to disk and hashed in the same pass, without holding it all in memory.
+
+        If the exam was downloaded in a previous run, only a HEAD request is
+        made first, and if the server reports the same ETag and size as back
+        then, the hash from that run is returned without downloading the exam.
 
         Parameters
         ----------
         exam : scraper.Exam
             Exam to download.
+        use_cache : bool
+            Whether to return the hash from a previous run if possible.
 
         Returns
         -------
         tuple[Optional[str], bytes]
-            File path of the downloaded exam and its hash.
+            File path of the downloaded exam and its hash. The file path is
+            None if the exam wasn't downloaded as its hash was already known.
+
+        Raises
+        ------
+        DownloadError
+            If exampapers responds with anything but the exam, or the download
+            is stopped.
         """
+        cached = self.cache.get_download(exam.download_url) if use_cache else None
+        if cached is not None:
+            r = exampapers_limiter.head(
+                self.session, exam.download_url, allow_redirects=True
+            )
+            content_length = r.headers.get("Content-Length")
+            # An error response says nothing about the exam, so download it
+            if (
+                r.ok
+                and r.headers.get("ETag") == cached["etag"]
+                and (content_length is None or content_length == str(cached["size"]))
+            ):
+                logger.debug(
+                    f"{exam.euclid_code}: {exam.title} is unchanged since last downloaded."
+                )
+                return None, cached["hash"]
+
         logger.debug(f"Downloading {exam.euclid_code}: {exam.title}...")
-        contents = self.session.get(exam.download_url).content
-        file_hash = hashlib.sha256(contents).digest()
+        hasher = hashing.new_hasher()
+        size = 0
+        filepath = os.path.join(self.scratch_dir, f"{uuid.uuid4().hex}.pdf")
+        with exampapers_limiter.get(self.session, exam.download_url, stream=True) as r:
+            # Never hash (and cache, or upload) an error page in place of the
+            # exam. This is checked before the scratch file is created.
+            if r.status_code != 200:
+                raise DownloadError(
+                    f"Failed ({r.status_code}) to download {exam.euclid_code}: {exam.title}."
+                )
+
+            with open(filepath, "wb") as f:
+                # Hashing happens here on the download worker thread. hashlib
+                # releases the GIL while hashing chunks this large, so hashes for
+                # concurrent downloads are calculated in parallel on multiple
+                # cores without needing a process pool.
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    if self.stopping.is_set():
+                        raise DownloadError(
+                            f"Stopped downloading {exam.euclid_code}: {exam.title}."
+                        )
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
 
-        # write to tmp file
-        f = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
-        f.write(contents)
-        f.close()
+        file_hash = hasher.digest()
+
+        # Remember the hash so the exam doesn't need to be downloaded next time,
+        # as long as the server can tell us whether it has changed
+        etag = r.headers.get("ETag")
+        if etag is not None:
+            self.cache.set_download(
+                exam.download_url, {"etag": etag, "size": size, "hash": file_hash}
+            )
 
-        logger.debug(f"Downloaded to {f.name} with hash {file_hash}")
-        return f.name, file_hash
+        logger.debug(f"Downloaded to {filepath} with hash {file_hash}")
+        return filepath, file_hash
@@ -0,0 +1,192 @@
+import logging
+import random
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# If the server reports fewer requests than this remaining in its quota (via
+# X-RateLimit-Remaining), pause until the quota resets
+LOW_REMAINING_THRESHOLD = 5
+
+
+class RateLimiter:
+    """Token bucket rate limiter that can be shared between threads. Requests
+    only block when more than `max_rate` requests have been made within
+    `time_period` seconds, or when the server has asked us to back off.
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 60) -> None:
+        """
+        Parameters
+        ----------
+        max_rate : float
+            Maximum number of requests allowed per time period. This is also
+            the maximum burst size.
+        time_period : float
+            Length of the time period in seconds.
+        """
+        self.max_rate = max_rate
+        self.time_period = time_period
+
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        # Minimum number of seconds between any two requests, regardless of
+        # tokens. Zero by default so requests only wait when they need to.
+        self.min_interval = 0.0
+        self.last_acquired = 0.0
+
+    def acquire(self) -> None:
+        """Block until a request is allowed to be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.max_rate,
+                    self.tokens
+                    + (now - self.last_refill) * self.max_rate / self.time_period,
+                )
+                self.last_refill = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif now < self.last_acquired + self.min_interval:
+                    wait = self.last_acquired + self.min_interval - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.last_acquired = now
+                    return
+                else:
+                    wait = (1 - self.tokens) * self.time_period / self.max_rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stop all requests through this limiter for the given duration.
+
+        Parameters
+        ----------
+        seconds : float
+            Number of seconds to pause for.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe(self, r: requests.Response) -> None:
+        """Pause if the server reports in its X-RateLimit-Remaining header that
+        its quota is nearly used up, until X-RateLimit-Reset (plus some jitter).
+
+        Parameters
+        ----------
+        r : requests.Response
+            Response to inspect.
+        """
+        try:
+            remaining = int(r.headers["X-RateLimit-Remaining"])
+        except (KeyError, ValueError):
+            return
+
+        if remaining >= LOW_REMAINING_THRESHOLD:
+            return
+
+        delay = 1.0
+        try:
+            reset = float(r.headers["X-RateLimit-Reset"])
+            # The reset is either a UNIX timestamp or a number of seconds
+            delay = max(delay, reset - time.time() if reset > 1e9 else reset)
+        except (KeyError, ValueError):
+            pass
+
+        delay += random.random()
+        logger.info(
+            f"Server reports {remaining} requests remaining, pausing for {delay:.1f}s."
+        )
+        self.pause(delay)
+
+    def request(
+        self, session: requests.Session, method: str, url: str, **kwargs: Any
+    ) -> requests.Response:
+        """Perform a rate-limited request. Retrying is left to the session's
+        adapter, but if the server still responds with 429 or 503, all requests
+        through this limiter back off for the duration given in its Retry-After
+        header (or a minute if not given). Likewise if the server reports that
+        its quota is nearly used up, later requests wait until it resets.
+
+        Parameters
+        ----------
+        session : requests.Session
+            Session to use for the request.
+        method : str
+            HTTP method of the request.
+        url : str
+            URL to request.
+        **kwargs : Any
+            Passed on to session.request.
+
+        Returns
+        -------
+        requests.Response
+            The response.
+        """
+        self.acquire()
+        r = session.request(method, url, **kwargs)
+        self.observe(r)
+
+        if r.status_code in (429, 503):
+            delay = parse_retry_after(r)
+            if delay is None:
+                delay = 60 + random.random()
+
+            logger.warning(
+                f"Rate-limited ({r.status_code}) on {url}, backing off for {delay:.1f}s."
+            )
+            self.pause(delay)
+
+        return r
+
+    def get(
+        self, session: requests.Session, url: str, **kwargs: Any
+    ) -> requests.Response:
+        """Perform a rate-limited GET request. See `request`."""
+        return self.request(session, "GET", url, **kwargs)
+
+    def head(
+        self, session: requests.Session, url: str, **kwargs: Any
+    ) -> requests.Response:
+        """Perform a rate-limited HEAD request. See `request`."""
+        return self.request(session, "HEAD", url, **kwargs)
+
+
+def parse_retry_after(r: requests.Response) -> Optional[float]:
+    """Get the number of seconds to wait from a response's Retry-After header.
+
+    Parameters
+    ----------
+    r : requests.Response
+        Response to inspect.
+
+    Returns
+    -------
+    Optional[float]
+        Seconds to wait, or None if the header is missing or not in seconds.
+    """
+    retry_after = r.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        return None
+
+
+# Shared limiter for all requests to exampapers.ed.ac.uk. This averages out to
+# one request every 3 seconds, which is what the previous fixed sleeps between
+# exams amounted to, but allows short bursts.
+exampapers_limiter = RateLimiter(max_rate=20, time_period=60)
@@ -1,20 +1,39 @@
 import datetime
-import itertools
 import requests
 import logging
+from typing import NamedTuple
 from loader import Loader
+from rate_limiter import exampapers_limiter
 
 logger = logging.getLogger(__name__)
 
+# Formats of exam issue dates seen on exampapers, most common first
+ISSUED_DATE_FORMATS = ["%Y-%m-%d", "%d-%m-%Y", "%Y/%m/%d", "%d/%m/%Y"]
 
-class Exam:
+# English month abbreviations, as strftime's %b would give in the C locale
+MONTH_ABBREVIATIONS = (
+    "Jan",
+    "Feb",
+    "Mar",
+    "Apr",
+    "May",
+    "Jun",
+    "Jul",
+    "Aug",
+    "Sep",
+    "Oct",
+    "Nov",
+    "Dec",
+)
+
+
+class Exam(NamedTuple):
     """Represents an exam paper on exampaers.ed.ac.uk"""
 
-    def __init__(self, title: str, euclid_code: str, year: str, download_url: str):
-        self.title = title
-        self.euclid_code = euclid_code
-        self.year = year
-        self.download_url = download_url
+    title: str
+    euclid_code: str
+    year: str
+    download_url: str
 
     def __str__(self):
         return f"{self.euclid_code}: {self.title} ({self.year}) - {self.download_url}"
@@ -23,8 +42,58 @@ class Exam:
         return str(self)
 
 
+def format_issued_date(issued_date: str) -> str:
+    """Normalise an exam issue date from exampapers as "YYYY MMM", such as
+    "2021 May".
+
+    Parameters
+    ----------
+    issued_date : str
+        Issue date in one of the ISSUED_DATE_FORMATS.
+
+    Returns
+    -------
+    str
+        Year and abbreviated month of the date.
+
+    Raises
+    ------
+    ValueError
+        If the date is not in any of the known formats.
+    """
+    # Nearly every date is YYYY-MM-DD, which is cheap to slice without strptime.
+    # Anything that isn't a valid date of that form is left to strptime below,
+    # so that the same dates are accepted and rejected either way.
+    if (
+        len(issued_date) == 10
+        and issued_date.isascii()
+        and issued_date[4] == "-"
+        and issued_date[7] == "-"
+    ):
+        year, month, day = issued_date[:4], issued_date[5:7], issued_date[8:]
+        if year.isdigit() and month.isdigit() and day.isdigit():
+            try:
+                datetime.date(int(year), int(month), int(day))
+            except ValueError:
+                pass
+            else:
+                return f"{year} {MONTH_ABBREVIATIONS[int(month) - 1]}"
+
+    for date_format in ISSUED_DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(issued_date, date_format)
+        except ValueError:
+            continue
+        return f"{date.year:04} {MONTH_ABBREVIATIONS[date.month - 1]}"
+
+    raise ValueError(f"Unrecognized exam issue date format: {issued_date}")
+
+
 def scrape_exams_on_page(
-    session: requests.Session, page: int, academic_year: str | None = None
+    session: requests.Session,
+    page: int,
+    academic_year: str | None = None,
+    show_loader: bool = True,
 ) -> tuple[bool, list[Exam]]:
     """Given a page number, scrape and return all exams on that page on
     exampapers.ed.ac.uk. The page number is 0-indexed and is used to paginate
@@ -38,6 +107,10 @@ def scrape_exams_on_page(
         Page number to scrape. 0-indexed.
     academic_year : str | None
         Academic year to filter exams by. If None, all exams will be returned.
+    show_loader : bool
+        Whether to display a loader while scraping. Should be False when the
+        page is scraped in the background, so as not to conflict with the
+        loader of whatever is running in the foreground.
 
     Returns
     -------
@@ -51,9 +124,12 @@ def scrape_exams_on_page(
     Exception
         If any required fields are missing in the API response.
     """
-    loader = Loader(f"Retrieving exams on page {page}...", "", 0.1).start()
+    loader = Loader(f"Retrieving exams on page {page}...", "", 0.1)
+    if show_loader:
+        loader.start()
 
-    r = session.get(
+    r = exampapers_limiter.get(
+        session,
         f"https://exampapers.ed.ac.uk/server/api/discover/search/objects",
         params={
             # Sort by academic year descending
@@ -73,13 +149,19 @@ def scrape_exams_on_page(
         },
     )
 
+    # These are how a session that is no longer logged in shows up, which the
+    # caller may recover from, so don't leave the loader running over it
     if r.status_code != 200:
+        if show_loader:
+            loader.cancel()
         raise Exception(f"Failed to get page {page}. Status code: {r.status_code}")
 
     try:
         data = r.json()
     except Exception as e:
         logger.error("Could not decode response as JSON, is the user really logged in?")
+        if show_loader:
+            loader.cancel()
         raise e
 
     if "_embedded" not in data or "searchResult" not in data["_embedded"]:
@@ -102,7 +184,6 @@ def scrape_exams_on_page(
     this_page_final = (
         search_result["page"]["totalPages"] == search_result["page"]["number"] + 1
     )
-    items_on_page = len(search_result["_embedded"]["objects"])
 
     # Parse exams
     exams: list[Exam] = []
@@ -111,22 +192,24 @@ def scrape_exams_on_page(
             "Unexpected response format from the API: searchResult._embedded.objects not found"
         )
 
-    for exam_node in search_result["_embedded"]["objects"]:
-        if (
-            "_embedded" not in exam_node
-            or "indexableObject" not in exam_node["_embedded"]
-        ):
+    exam_nodes = search_result["_embedded"]["objects"]
+    items_on_page = len(exam_nodes)
+
+    for exam_node in exam_nodes:
+        # Each level of nesting is looked up once and kept, rather than walked
+        # again from the top for every check and field
+        indexable_object = exam_node.get("_embedded", {}).get("indexableObject")
+        if indexable_object is None:
             raise Exception(
                 "Unexpected response format from the API: Exam node doesn't have indexableObject"
             )
 
-        if "metadata" not in exam_node["_embedded"]["indexableObject"]:
+        metadata = indexable_object.get("metadata")
+        if metadata is None:
             raise Exception(
                 "Unexpected response format from the API: indexableObject doesn't have metadata"
             )
 
-        metadata = exam_node["_embedded"]["indexableObject"]["metadata"]
-
         if (
             "dc.identifier" not in metadata
             or "dc.date.issued" not in metadata
@@ -137,54 +220,45 @@ def scrape_exams_on_page(
             )
 
         course_code = metadata["dc.identifier"][0]["value"]
-        # Parse known date formats and normalize as "YYYY MMM"
-        issued_date = metadata["dc.date.issued"][0]["value"]
-        date_formats = ["%Y-%m-%d", "%d-%m-%Y", "%Y/%m/%d", "%d/%m/%Y"]
-        for date_format in date_formats:
-            try:
-                year = datetime.datetime.strptime(issued_date, date_format).strftime(
-                    "%Y %b"
-                )
-                break
-            except ValueError:
-                continue
-        else:
-            raise ValueError(
-                f"Unrecognized exam issue date format: {issued_date}")
+        year = format_issued_date(metadata["dc.date.issued"][0]["value"])
 
         title = metadata["dc.title"][0]["value"]
 
         # There's a lot of useless nesting in the DSpace API when requesting embedded resources
-        if (
-            "_embedded" not in exam_node["_embedded"]["indexableObject"]
-            or "bundles" not in exam_node["_embedded"]["indexableObject"]["_embedded"]
-            or "_embedded"
-            not in exam_node["_embedded"]["indexableObject"]["_embedded"]["bundles"]
-            or "bundles"
-            not in exam_node["_embedded"]["indexableObject"]["_embedded"]["bundles"][
-                "_embedded"
-            ]
-        ):
+        bundles = (
+            indexable_object.get("_embedded", {})
+            .get("bundles", {})
+            .get("_embedded", {})
+            .get("bundles")
+        )
+        if bundles is None:
             raise Exception(
                 "Unexpected response format from the API: indexableObject doesn't have bundles"
             )
 
-        # Get all bitstream nodes in all bundles
-        bitstreams = itertools.chain.from_iterable(
-            bundle["_embedded"]["bitstreams"]["_embedded"]["bitstreams"]
-            for bundle in exam_node["_embedded"]["indexableObject"]["_embedded"][
-                "bundles"
-            ]["_embedded"]["bundles"]
-        )
+        # Find the original bundle, which contains the PDF, by its name and
+        # take its bitstream, without looking at the bitstreams of any other
+        # bundles (thumbnails, extracted text, licences)
+        original_node = None
+        for bundle in bundles:
+            if bundle.get("name") == "ORIGINAL":
+                original_bitstreams = bundle["_embedded"]["bitstreams"]["_embedded"][
+                    "bitstreams"
+                ]
+                if original_bitstreams:
+                    original_node = original_bitstreams[0]
+                break
 
-        # Filter for the bitstream in the original bundle, which contains the PDF
-        original_node = [
-            b for b in bitstreams if "bundleName" in b and b["bundleName"] == "ORIGINAL"
-        ][0]
+        if original_node is None:
+            raise Exception(
+                f"Unexpected response format from the API: {course_code} {title} doesn't have an ORIGINAL bitstream"
+            )
 
         download_url = original_node["_links"]["content"]["href"]
         exams.append(Exam(title, course_code, year, download_url))
 
-    loader.stop(f"{items_on_page} exams downloadable.")
+    logger.debug(f"Page {page} has {items_on_page} exams downloadable.")
+    if show_loader:
+        loader.stop(f"{items_on_page} exams downloadable.")
 
     return this_page_final, exams
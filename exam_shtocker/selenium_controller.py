@@ -19,10 +19,52 @@ from selenium.webdriver.firefox.options import Options as FFOptions
 from selenium.webdriver.firefox.service import Service as FFService
 from selenium.webdriver.firefox.webdriver import WebDriver
 
+from auth import is_exampapers_cookie_domain
+
 logger = logging.getLogger(__name__)
 
 HEADLESS = True
 WAIT_SECONDS = 30
+# How often to check the page while waiting for something to appear. Selenium's
+# default of 0.5s adds up to half a second of latency to every step of the
+# login; much below 0.05s only burns CPU in the browser.
+POLL_SECONDS = 0.1
+# When waiting for text in the page source, the poll interval grows by this
+# factor after every miss, up to the maximum. The maximum is kept low, as it is
+# also how late the script may notice that the page has changed.
+POLL_BACKOFF = 1.5
+MAX_POLL_SECONDS = 0.5
+
+# Overlay shown on the Microsoft login page while it is busy. Looked up as an
+# element so the browser answers with a list of matches, rather than us
+# transferring the whole page source to search in it.
+LOADING_COVER_SELECTOR = ".lightbox-cover.disable-lightbox"
+
+# Case-insensitive substring search over the page's HTML, run in the browser so
+# that only the result is sent back rather than the whole page source
+PAGE_CONTAINS_SCRIPT = """
+return document.documentElement.outerHTML.toLowerCase().includes(arguments[0]);
+"""
+
+# Index of the first of a list of lowercase phrases that the page's HTML
+# contains, or -1 if it contains none of them
+PAGE_CONTAINS_ANY_SCRIPT = """
+const html = document.documentElement.outerHTML.toLowerCase();
+return arguments[0].findIndex((phrase) => html.includes(phrase));
+"""
+
+# Whether each of the two verification method XPaths is on the page and whether
+# the loading cover is up, all checked with a single round trip to the browser
+PROOFS_STATE_SCRIPT = """
+const present = (xpath) => document.evaluate(
+    xpath, document, null, XPathResult.BOOLEAN_TYPE, null
+).booleanValue;
+return [
+    present(arguments[0]),
+    present(arguments[1]),
+    document.querySelector(arguments[2]) !== null,
+];
+"""
 
 
 class SeleniumLauncherReturnValues(TypedDict):
@@ -66,16 +108,35 @@ def make_driver() -> WebDriver:
 
 
 def wait_presence_soft(
-    driver: WebDriver, by: str, locator: str, timeout: float = WAIT_SECONDS
+    driver: WebDriver,
+    by: str,
+    locator: str,
+    timeout: float = WAIT_SECONDS,
+    poll_interval: float = POLL_SECONDS,
 ):
     try:
-        return WebDriverWait(driver, timeout).until(
+        return WebDriverWait(driver, timeout, poll_frequency=poll_interval).until(
             EC.presence_of_element_located((by, locator))
         )
     except TimeoutException:
         return None
 
 
+def wait_absence_soft(
+    driver: WebDriver,
+    by: str,
+    locator: str,
+    timeout: float = WAIT_SECONDS,
+    poll_interval: float = POLL_SECONDS,
+) -> bool:
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=poll_interval).until_not(
+            EC.presence_of_element_located((by, locator))
+        )
+    except TimeoutException:
+        return False
+
+
 def send_keys_if_present(
     driver: WebDriver,
     by: str,
@@ -100,11 +161,15 @@ def send_keys_if_present(
 
 
 def click_if_present(
-    driver: WebDriver, by: str, locator: str, timeout: float = WAIT_SECONDS
+    driver: WebDriver,
+    by: str,
+    locator: str,
+    timeout: float = WAIT_SECONDS,
+    poll_interval: float = POLL_SECONDS,
 ):
     try:
         if timeout:
-            el = WebDriverWait(driver, timeout).until(
+            el = WebDriverWait(driver, timeout, poll_frequency=poll_interval).until(
                 EC.element_to_be_clickable((by, locator))
             )
         else:
@@ -120,20 +185,26 @@ def wait_until_source_contains_any(
     driver: WebDriver,
     phrases: list[str],
     timeout: float = WAIT_SECONDS,
-    poll_interval: float = 0.5,
+    poll_interval: float = POLL_SECONDS,
 ):
-    end = time.time() + timeout
-    lowers = [p.lower() for p in phrases]
-    while time.time() < end:
+    end = time.monotonic() + timeout
+    lowered = [p.lower() for p in phrases]
+    while True:
         try:
-            src = (driver.page_source or "").lower()
-            for i, p in enumerate(lowers):
-                if p in src:
-                    return phrases[i]
+            index = driver.execute_script(PAGE_CONTAINS_ANY_SCRIPT, lowered)
+            if index >= 0:
+                return phrases[index]
         except Exception:
             pass
-        time.sleep(poll_interval)
-    return None
+
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(poll_interval, remaining))
+
+        # Every check is a round trip to the browser and a serialisation of the
+        # page there, so check less and less often the longer the wait goes on
+        poll_interval = min(poll_interval * POLL_BACKOFF, MAX_POLL_SECONDS)
 
 
 def get_text_if_present(
@@ -155,7 +226,7 @@ def xpath_present(driver: WebDriver, by: str, locator: str) -> bool:
 
 def page_contains(driver: WebDriver, phrase: str) -> bool:
     try:
-        return phrase.lower() in (driver.page_source or "").lower()
+        return bool(driver.execute_script(PAGE_CONTAINS_SCRIPT, phrase.lower()))
     except Exception:
         return False
 
@@ -178,7 +249,6 @@ def submit_validate_username_password(
         driver,
         phrases=["lightboxTemplateContainer", "Incorrect user ID or password"],
         timeout=WAIT_SECONDS,
-        poll_interval=0.5,
     ):
         return False
 
@@ -199,7 +269,7 @@ class TWO_FACTOR_TYPE(enum.Enum):
 
 
 def wait_for_2fa_prompt(
-    driver: WebDriver,
+    driver: WebDriver, poll_interval: float = POLL_SECONDS
 ) -> Optional[tuple[TWO_FACTOR_TYPE, Optional[str]]]:
     wait_until_source_contains_any(
         driver,
@@ -209,16 +279,24 @@ def wait_for_2fa_prompt(
             "Enter the code displayed",
         ],
         timeout=WAIT_SECONDS,
-        poll_interval=0.5,
+        poll_interval=poll_interval,
     )
 
     if page_contains(driver, "trouble verifying your account"):
         proof1 = '//*[@id="idDiv_SAOTCS_Proofs"]/div[1]/div'
         proof2 = '//*[@id="idDiv_SAOTCS_Proofs"]/div[2]/div'
 
-        while True:
-            has1 = xpath_present(driver, By.XPATH, proof1)
-            has2 = xpath_present(driver, By.XPATH, proof2)
+        end = time.monotonic() + WAIT_SECONDS
+        while time.monotonic() < end:
+            try:
+                has1, has2, loading = driver.execute_script(
+                    PROOFS_STATE_SCRIPT, proof1, proof2, LOADING_COVER_SELECTOR
+                )
+            except Exception:
+                # The page may be in the middle of navigating, which doesn't
+                # mean the options are gone, so check again
+                time.sleep(poll_interval)
+                continue
 
             # Exit when neither XPath is on the page
             if not (has1 or has2):
@@ -227,23 +305,25 @@ def wait_for_2fa_prompt(
 
             if has1:
                 # print("found 1")
-                while True:
-                    if page_contains(driver, "lightbox-cover disable-lightbox"):
-                        # print("1: loading wait")
-                        time.sleep(0.5)
-                    else:
-                        break
+                if loading:
+                    wait_absence_soft(
+                        driver,
+                        By.CSS_SELECTOR,
+                        LOADING_COVER_SELECTOR,
+                        poll_interval=poll_interval,
+                    )
                 # print("broke 1")
                 click_if_present(driver, By.XPATH, proof1)
 
             if has2:
                 # print("found 2")
-                while True:
-                    if page_contains(driver, "lightbox-cover disable-lightbox"):
-                        # print("2: loading wait")
-                        time.sleep(0.5)
-                    else:
-                        break
+                if loading:
+                    wait_absence_soft(
+                        driver,
+                        By.CSS_SELECTOR,
+                        LOADING_COVER_SELECTOR,
+                        poll_interval=poll_interval,
+                    )
                 # print("broke 2")
                 click_if_present(driver, By.XPATH, proof2)
 
@@ -253,7 +333,7 @@ def wait_for_2fa_prompt(
             driver,
             phrases=["Open your Authenticator", "Enter the code displayed"],
             timeout=WAIT_SECONDS,
-            poll_interval=0.5,
+            poll_interval=poll_interval,
         )
 
     if page_contains(driver, "Enter the code displayed"):
@@ -274,13 +354,17 @@ def input_2fa_otp(driver: WebDriver, otp_code: str):
         click_if_present(driver, By.XPATH, '//*[@id="idSubmit_SAOTCC_Continue"]')
 
 
-def wait_for_2fa_completion(driver: WebDriver):
-    if not wait_presence_soft(driver, By.ID, "idSIButton9"):
+def wait_for_2fa_completion(driver: WebDriver, poll_interval: float = POLL_SECONDS):
+    if not wait_presence_soft(
+        driver, By.ID, "idSIButton9", poll_interval=poll_interval
+    ):
         return False
-    if not click_if_present(driver, By.ID, "idSIButton9"):
+    if not click_if_present(driver, By.ID, "idSIButton9", poll_interval=poll_interval):
         return False
 
-    return wait_presence_soft(driver, By.ID, "notification-icon")
+    return wait_presence_soft(
+        driver, By.ID, "notification-icon", poll_interval=poll_interval
+    )
 
 
 def retrieve_logged_in_name(driver: WebDriver) -> Optional[str]:
@@ -325,13 +409,16 @@ def retrieve_exampapers_cookies(driver: WebDriver) -> Optional[list[dict[str, st
 
 def copy_cookies_to_session(cookies: list[dict[str, Any]], session: requests.Session):
     for cookie in cookies:
+        # Only cookies that would be sent to exampapers are of any use, which
+        # includes those set for a parent domain such as .ed.ac.uk
+        if not is_exampapers_cookie_domain(cookie.get("domain", "")):
+            continue
+
         if "httpOnly" in cookie:
-            httpO = cookie.pop("httpOnly")
-            cookie["rest"] = {"httpOnly": httpO}
+            cookie["rest"] = {"httpOnly": cookie.pop("httpOnly")}
         if "expiry" in cookie:
             cookie["expires"] = cookie.pop("expiry")
-        if "sameSite" in cookie:
-            del cookie["sameSite"]
+        cookie.pop("sameSite", None)
         session.cookies.set(**cookie)  # type: ignore
 
-    logger.info(session.cookies.get_dict())
+    logger.debug(session.cookies.get_dict())
@@ -1,8 +1,14 @@
 import logging
 import re
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from typing import Optional
 import requests
+from cache import Cache
 from VERSION import VERSION
-from colorama import Fore
+from colors import Fore
 
 REMOTE_URL = "https://github.com/yutotakano/exam-shtocker"
 REMOTE_ISSUES_URL = "https://github.com/yutotakano/exam-shtocker/issues"
@@ -14,39 +20,130 @@ logger = logging.getLogger(__name__)
 # Regex to parse the version string from the VERSION file
 # This is a simple regex that matches the version string in the format:
 # VERSION = "x.y.z"
-version_regex = re.compile(r'VERSION = "(.*)"')
+# Anchored to a line of its own, and stopping at the closing quote, so that a
+# malformed file can't match part of something else
+version_regex = re.compile(r'^VERSION\s*=\s*"([^"]+)"\s*$', re.MULTILINE)
 
+# The remote version is only re-checked once a day, and cached in between
+VERSION_CACHE_MAX_AGE = 24 * 60 * 60
 
-def check_for_updates():
-    # If there are updates, we will warn but not fail
-    try:
-        remote_version_file = requests.get(REMOTE_VERSION_URL).text.strip()
-        remote_version_search = version_regex.search(remote_version_file)
-        if remote_version_search is None:
-            print(
-                Fore.YELLOW
-                + f"! Could not parse remote version file. Please check {REMOTE_ISSUES_URL} for updates."
-                + Fore.RESET
-            )
-            logger.warning(
-                f"Could not parse remote version file. Please check {REMOTE_ISSUES_URL} for updates."
-            )
-            return
-        remote_version = remote_version_search.group(1)
-
-        if remote_version != VERSION:
-            print(
-                Fore.YELLOW
-                + f"! New version available: {remote_version}. You are using {VERSION}."
-                + Fore.RESET
-            )
-            logger.warning(
-                f"New version available: {remote_version}. You are using {VERSION}."
-            )
-            logger.warning(
-                f"If you encounter issues, we recommend re-downloading the script from {REMOTE_URL}."
-            )
+# Connect and read timeouts for fetching the remote version, in seconds. The
+# check is only advisory, so it shouldn't hold up the script for long.
+UPDATE_CHECK_TIMEOUT = (3, 5)
+
+
+def get_remote_version() -> Optional[str]:
+    """Get the latest version of the script, from the cache if it was checked
+    recently, or otherwise from the remote repository. The remote file is
+    requested with the ETag of the previous check, so it is not downloaded
+    again if it hasn't changed.
+
+    Returns
+    -------
+    Optional[str]
+        The latest version, or None if the remote version file couldn't be
+        parsed.
+
+    Raises
+    ------
+    requests.RequestException
+        If the remote repository couldn't be reached, took too long to
+        respond, or the request failed otherwise.
+    """
+    with closing(Cache()) as cache:
+        cached = cache.get_remote_version(REMOTE_VERSION_URL)
+        if (
+            cached is not None
+            and time.time() - cached["checked_at"] < VERSION_CACHE_MAX_AGE
+        ):
+            logger.debug("Using cached remote version.")
+            return cached["version"]
+
+        headers = {}
+        if cached is not None and cached["etag"] is not None:
+            headers["If-None-Match"] = cached["etag"]
+
+        r = requests.get(
+            REMOTE_VERSION_URL, headers=headers, timeout=UPDATE_CHECK_TIMEOUT
+        )
+        etag = r.headers.get("ETag")
+        if r.status_code == 304 and cached is not None:
+            logger.debug("Remote version file has not changed.")
+            remote_version = cached["version"]
+            etag = etag or cached["etag"]
         else:
-            logger.info("You are using the latest version.")
-    except requests.exceptions.ConnectionError:
-        logger.warning("Could not check for updates.")
+            remote_version_search = version_regex.search(r.text.strip())
+            if remote_version_search is None:
+                return None
+            remote_version = remote_version_search.group(1)
+
+        cache.set_remote_version(
+            REMOTE_VERSION_URL,
+            {
+                "version": remote_version,
+                "etag": etag,
+                "checked_at": time.time(),
+            },
+        )
+        return remote_version
+
+
+def start_update_check() -> "Future[Optional[str]]":
+    """Start getting the latest version of the script in a background thread,
+    so that the request overlaps with whatever the script does next (such as
+    logging in). Pass the result to finish_update_check to report it.
+
+    Returns
+    -------
+    Future[Optional[str]]
+        Future resolving to the result of get_remote_version.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    update_check = executor.submit(get_remote_version)
+    executor.shutdown(wait=False)
+    return update_check
+
+
+def finish_update_check(update_check: "Future[Optional[str]]"):
+    """Wait for an update check started with start_update_check, and warn if
+    there is a newer version.
+
+    Parameters
+    ----------
+    update_check : Future[Optional[str]]
+        The update check to finish.
+    """
+    # If there are updates, we will warn but not fail. The check is only
+    # advisory, so neither does anything going wrong with the check itself:
+    # request errors, and reading or parsing the cached version.
+    try:
+        remote_version = update_check.result()
+    except (requests.RequestException, OSError, ValueError, sqlite3.Error) as e:
+        logger.debug(f"Could not check for updates: {e}")
+        return None
+
+    if remote_version is None:
+        print(
+            Fore.YELLOW
+            + f"! Could not parse remote version file. Please check {REMOTE_ISSUES_URL} for updates."
+            + Fore.RESET
+        )
+        logger.warning(
+            f"Could not parse remote version file. Please check {REMOTE_ISSUES_URL} for updates."
+        )
+        return
+
+    if remote_version != VERSION:
+        print(
+            Fore.YELLOW
+            + f"! New version available: {remote_version}. You are using {VERSION}."
+            + Fore.RESET
+        )
+        logger.warning(
+            f"New version available: {remote_version}. You are using {VERSION}."
+        )
+        logger.warning(
+            f"If you encounter issues, we recommend re-downloading the script from {REMOTE_URL}."
+        )
+    else:
+        logger.info("You are using the latest version.")